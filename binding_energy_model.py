@@ -4,6 +4,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import keras
+import tensorflow as tf
 from keras.models import Sequential
 from keras.layers import Dense
 import workflow
@@ -11,6 +12,8 @@ from embedding_generator import EmbeddingGenerator
 
 name = 'seq85k'
 use_cpu = False
+quantize_for_inference = False # evaluate generated sequences with an int8 TFLite model
+quantization_tolerance = 0.1 # max deviation (DDG) from the float model on the test split
 
 foldx_dict = workflow.import_energy_metadata_foldx()
 seqs = workflow.get_embedding_list(name)
@@ -52,7 +55,21 @@ def main():
     # with keras BatchNorm
     model.fit(test_data) 
 
-    evaluate(model)
+    inference_model = fuse_batchnorm(model)
+    if quantize_for_inference:
+        print('AbReg - Quantize model')
+        quantized_model = quantize(inference_model, train_data, model_fp + '.tflite')
+
+        # Check the int8 predictions against the float model's before evaluating with them
+        test_inputs = EmbeddingGenerator(name, seqs[81000:82000], foldx_dict, batch_size, include_targets=False)
+        deviation = np.abs(predict_quantized(quantized_model, test_inputs) - inference_model.predict(test_inputs))
+        print('AbReg - Quantized vs float test predictions: max deviation %.4f, mean deviation %.4f' % (deviation.max(), deviation.mean()))
+        if deviation.max() <= quantization_tolerance:
+            inference_model = quantized_model
+        else:
+            print('AbReg - Quantized model exceeds tolerance %.4f; evaluating with the float model' % quantization_tolerance)
+
+    evaluate(inference_model)
 
 
 def RegressionModel():
@@ -80,6 +97,76 @@ def RegressionModel():
 	return model
     
 
+# Build an inference-only copy of a trained model with every BatchNormalization folded into
+# the Dense layer that follows it and Dropout (a no-op at inference) removed. BatchNorm comes
+# after the ReLU in RegressionModel, so it is folded into the next Dense's inputs
+# (W' = scale * W, b' = b + shift . W) rather than the previous Dense's outputs.
+def fuse_batchnorm(model):
+	X_input = keras.Input(shape=model.input_shape[1:])
+	X = X_input
+	scale, shift = None, None
+
+	for layer in model.layers:
+		if isinstance(layer, (keras.layers.InputLayer, keras.layers.Dropout)):
+			continue
+
+		if isinstance(layer, keras.layers.BatchNormalization):
+			gamma, beta, mean, var = layer.get_weights()
+			scale = gamma / np.sqrt(var + layer.epsilon)
+			shift = beta - mean * scale
+			continue
+
+		fused = layer.__class__.from_config(layer.get_config())
+		X = fused(X)
+		weights = layer.get_weights()
+		if scale is not None:
+			assert isinstance(layer, Dense), 'Expected BatchNormalization to be followed by a Dense layer'
+			W, b = weights
+			weights = [W * scale[:, None], b + np.dot(shift, W)]
+			scale, shift = None, None
+		fused.set_weights(weights)
+
+	return keras.Model(inputs = X_input, outputs = X, name=model.name + '_fused')
+
+
+# Post-training int8 quantization with TFLite. Samples from data (a keras Sequence of
+# (inputs, targets)) calibrate the activation ranges; ops without an int8 kernel stay float.
+# Returns a TFLite interpreter, and writes the quantized model to fp if given.
+def quantize(model, data, fp=None, num_samples=100):
+	def representative_dataset():
+		n = 0
+		for i in range(len(data)):
+			for x in data[i][0]:
+				if n == num_samples: return
+				yield [x[None].astype(np.float32)]
+				n += 1
+
+	converter = tf.lite.TFLiteConverter.from_keras_model(model)
+	converter.optimizations = [tf.lite.Optimize.DEFAULT]
+	converter.representative_dataset = representative_dataset
+	tflite_model = converter.convert()
+
+	if fp:
+		with open(fp, 'wb') as f:
+			f.write(tflite_model)
+
+	interpreter = tf.lite.Interpreter(model_content=tflite_model)
+	interpreter.allocate_tensors()
+	return interpreter
+
+
+def predict_quantized(interpreter, data):
+	input_index = interpreter.get_input_details()[0]['index']
+	output_index = interpreter.get_output_details()[0]['index']
+	predictions = []
+	for i in range(len(data)):
+		for x in data[i]:
+			interpreter.set_tensor(input_index, x[None].astype(np.float32))
+			interpreter.invoke()
+			predictions.append(interpreter.get_tensor(output_index)[0])
+	return np.stack(predictions)
+
+
 def evaluate(model):
 	predictions = {}
 	prediction_types = [
@@ -98,7 +185,10 @@ def evaluate(model):
 		labels = workflow.get_embedding_list(n)
 		# Note: batch size *must* not be larger than data size
 		predicted_embeddings = EmbeddingGenerator(n, labels, foldx_dict, len(labels), include_targets=False)
-		predicted_energies = model.predict(predicted_embeddings)
+		if isinstance(model, tf.lite.Interpreter):
+			predicted_energies = predict_quantized(model, predicted_embeddings)
+		else:
+			predicted_energies = model.predict(predicted_embeddings)
 		predictions[n] = predicted_energies
 
 	print('AbReg - Evaluate predicted whole-model binding energy of generated embeddings')
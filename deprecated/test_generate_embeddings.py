@@ -47,9 +47,9 @@ with torch.no_grad():
 
 
 # Note that token 0 for each seq is BOS so it should be ignored. First residue is token 1.
-token_embeddings = np.delete(results["representations"][34], (0), axis=1) # go from (2, 459, 1280) -> (2, 458, 1280)
-logits = np.delete(results["logits"], (0), axis=1)
-tokens = np.delete(tokens, (0), axis=1)
+token_embeddings = results["representations"][34][:, 1:] # go from (2, 459, 1280) -> (2, 458, 1280)
+logits = results["logits"][:, 1:]
+tokens = tokens[:, 1:]
 
 '''
 # OPTIONALLY, Generate per-sequence embeddings via averaging
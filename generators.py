@@ -13,21 +13,20 @@ class Generators:
 		print('Generate %s predictions' % name)
 		assert not os.path.exists(fasta_fp(name)), '%s fasta already exists' % name
 	
+		# Work on byte arrays so a whole batch of mutants is drawn with one randint call
+		seq_arr = np.frombuffer(seq.encode(), dtype=np.uint8)
+		vocab_arr = np.frombuffer(''.join(vocab).encode(), dtype=np.uint8)
+		mask_idx = np.asarray(masks) - 1 # masks are 1-indexed
+
 		random_seqs = set()
 		while len(random_seqs) < num_seqs:
-			mutant=''
-			for i,residue in enumerate(seq):
-				if (i+1) in masks:
-					mutant += np.random.choice(vocab)
-				else:
-					mutant += residue
-			random_seqs.add(mutant)
+			mutants = np.tile(seq_arr, (num_seqs - len(random_seqs), 1))
+			mutants[:, mask_idx] = vocab_arr[np.random.randint(len(vocab_arr), size=(mutants.shape[0], len(mask_idx)))]
+			random_seqs.update(mutant.tobytes().decode() for mutant in mutants)
 		random_seqs = list(random_seqs)
 
 		with open(fasta_fp(name), 'w') as f:
-			for n in range(num_seqs):
-				f.write('>%s_%d\n' % (name, n+1))
-				f.write('%s\n' % random_seqs[n])
+			f.write(''.join('>%s_%d\n%s\n' % (name, n+1, random_seqs[n]) for n in range(num_seqs)))
 
 
 	def generate_substitution_predictions(seq, masks, num_seqs):
@@ -48,11 +47,12 @@ class Generators:
 			for j in range(20):
 				probmat[i][j] = priors[i]*priors[j]*2**(scale*submat[i][j])
 
+		mask_set = frozenset(masks) # O(1) membership test per residue
 		sub_seqs = set()
 		while len(sub_seqs) < num_seqs:
 			mutant=''
 			for i,residue in enumerate(seq):
-				if (i+1) in masks:
+				if (i+1) in mask_set:
 					dist=probmat[amino_acids.index(residue),:]
 					dist=dist/np.sum(dist)
 					mutant += np.random.choice(amino_acids, p=dist)
@@ -1,34 +1,32 @@
 import torch
-import numpy as np
-import subprocess
 import esm_src.esm as esm
+import h5py
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from argparse import Namespace
 import random
+import functools
 import time
 import os
 
 data_dir = 'data'
 model_fp = 'models/esm1_t34_670M_UR50S.pt'
 all_masks = [31,32,33,47,50,51,52,54,55,57,58,59,60,61,62,99,100,101,102,103,104,271,273,274,275,335,336,337,338,340,341]
-embedding_dir = lambda name: os.path.join(data_dir, name + '_embeddings')
+embedding_h5_fp = lambda name: os.path.join(data_dir, name + '_embeddings.h5')
 fasta_fp = lambda name: os.path.join(data_dir, name + '.fasta')
 
-def model_predict_seqs(prediction_method, initial_seq, num_iters, use_cpu=False):
-	model, alphabet, batch_converter, initial_tokens = load_model_prediction_tools(initial_seq, use_cpu)
+# Each prediction method generates num_seqs sequences at once: every model forward pass
+# runs on the whole batch of candidates rather than one sequence at a time.
+def model_predict_seqs(prediction_method, initial_seq, num_seqs, use_cpu=False):
+	model, alphabet, initial_tokens = load_model_prediction_tools(initial_seq, use_cpu)
 
-	predictions = []
-	t0 = time.time()
-	for i in range(num_iters):
-		t1 = time.time()
-		predictions.append(prediction_method(initial_tokens, model, alphabet, i+1))
-		t2 = time.time()
-		print('iter %d of %d: %.1f min (%.1f min total)' % (i+1, num_iters, (t2-t1)/60, (t2-t0)/60))
+	device = model_device(model)
 
-	# return compute_predicted_seq_embeddings(model, batch_converter, predictions)
-	labels = [x[0] for x in predictions]
-	tokens = np.delete(torch.cat([x[1] for x in predictions]), (0), axis=1) # remove BOS token
-	strs = tokens2strs(alphabet, tokens)
+	t0 = time.time()
+	labels, tokens = prediction_method(initial_tokens.repeat(num_seqs, 1).to(device), model, alphabet)
+	print('%s: %d seqs in %.1f min' % (prediction_method.__name__, num_seqs, (time.time()-t0)/60))
 
+	strs = tokens2strs(alphabet, tokens[:, 1:].cpu()) # remove BOS token
 
 	timestamp = time.strftime('%m%d_%H%M', time.localtime(time.time()))
 	name = prediction_method.__name__ + '_' + timestamp
@@ -39,8 +37,84 @@ def model_predict_seqs(prediction_method, initial_seq, num_iters, use_cpu=False)
 			f.write('>%s\n' % l)
 			f.write('%s\n' % s)
 
-	subprocess.run(['python3', 'esm_src/extract.py', model_fp, fasta_fp(name), embedding_dir(name), 
-		'--repr_layers', '34', '--include', 'per_tok'])
+	# Compute embeddings for all predicted seqs in one batched forward pass (in full precision,
+	# like extract_embeddings, so they are comparable with the other embeddings). The predicted
+	# tokens still start with BOS, so they go straight into the model without re-tokenizing strs.
+	with torch.no_grad():
+		results = model(tokens, repr_layers=[34])
+	# Sampled special tokens (e.g. <mask>) make strs longer than the token count, so slice by
+	# tokens: every row has the same length and no padding, only BOS to drop
+	with create_embeddings_file(embedding_h5_fp(name), labels) as f:
+		write_embeddings(f, 0, results['representations'][34][:, 1:].to(device='cpu').numpy())
+
+
+# In-process equivalent of esm_src/extract.py (--repr_layers 34 --include per_tok), using an
+# already-loaded model and writing all embeddings into a single HDF5 file at out_fp
+def extract_embeddings(model, alphabet, fasta_file, out_fp, toks_per_batch=4096, max_pending_writes=8):
+	model.eval()
+	device = model_device(model)
+
+	dataset = esm.FastaBatchedDataset.from_file(fasta_file)
+	batches = dataset.get_batch_indices(toks_per_batch, extra_toks_per_seq=1)
+	data_loader = torch.utils.data.DataLoader(
+		dataset, collate_fn=alphabet.get_batch_converter(), batch_sampler=batches
+	)
+	print('Read %s with %d sequences' % (fasta_file, len(dataset)))
+	# Rows of the embeddings file are in the order the batches are processed
+	labels = [dataset.sequence_labels[i] for batch in batches for i in batch]
+
+	# Writes happen on a background thread so the next batch's forward pass overlaps the
+	# previous batch's write; at most max_pending_writes batches are held in memory.
+	pending_writes = threading.Semaphore(max_pending_writes)
+	def write(f, start, strs, results):
+		try:
+			save_embeddings(f, start, strs, results)
+		finally:
+			pending_writes.release()
+
+	with create_embeddings_file(out_fp, labels) as f, ThreadPoolExecutor(max_workers=1) as writer, torch.no_grad():
+		writes = []
+		start = 0
+		for batch_idx, (_, strs, toks) in enumerate(data_loader):
+			print('Processing %d of %d batches (%d sequences)' % (batch_idx + 1, len(batches), toks.size(0)))
+			toks = toks.to(device=device, non_blocking=True)
+
+			results = model(toks, repr_layers=[34])
+			pending_writes.acquire()
+			writes.append(writer.submit(write, f, start, strs, results))
+			start += len(strs)
+
+			# Stop at the first failed write rather than after the whole fasta
+			while writes and writes[0].done():
+				writes.pop(0).result()
+
+		for w in writes:
+			w.result() # raise any error from the writer thread
+
+
+# Open a new HDF5 embeddings file for the given labels (see workflow.embedding_h5_fp).
+# The (N, L, D) 'embeddings' array is created by the first save_embeddings call.
+def create_embeddings_file(fp, labels):
+	f = h5py.File(fp, 'w')
+	f.create_dataset('labels', data=labels, dtype=h5py.string_dtype())
+	return f
+
+
+# Write a batch's layer 34 per-token representations (without BOS/padding) to rows
+# start:start+len(strs) of the embeddings array. All sequences must have the same length.
+def save_embeddings(f, start, strs, results):
+	seq_len = len(strs[0])
+	assert all(len(s) == seq_len for s in strs), 'All sequences must have the same length'
+	write_embeddings(f, start, results['representations'][34][:, 1 : seq_len + 1].to(device='cpu').numpy())
+
+
+# Write a (B, L, D) array of per-token representations to rows start:start+B of the
+# embeddings array, creating it on the first write
+def write_embeddings(f, start, embeddings):
+	if 'embeddings' not in f:
+		f.create_dataset('embeddings', (len(f['labels']),) + embeddings.shape[1:], dtype='float32')
+	assert f['embeddings'].shape[1:] == embeddings.shape[1:], 'All sequences must have the same length'
+	f['embeddings'][start : start + len(embeddings)] = embeddings
 
 
 def load_model_prediction_tools(seq, use_cpu):
@@ -51,88 +125,103 @@ def load_model_prediction_tools(seq, use_cpu):
 	# Note this will also pad any sequence with different length
 	labels, strs, initial_tokens = batch_converter([('cov1_ab', seq)])
 
-	return model, alphabet, batch_converter, initial_tokens
+	return model, alphabet, initial_tokens
 
 
+# On GPU, the forward passes used for sampling run under fp16 autocast, with TF32 allowed
+# for the remaining fp32 matmuls. TF32 is only enabled here, so embeddings stay full precision.
 def unmask_token(tokens, model, alphabet, idx=-1):
-	with torch.no_grad():
-		results = model(tokens, repr_layers=[34])
+	device = model_device(model)
+	allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+	torch.backends.cuda.matmul.allow_tf32 = True
+	try:
+		with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+			results = model(tokens, repr_layers=[34])
+	finally:
+		torch.backends.cuda.matmul.allow_tf32 = allow_tf32
 	tokens, _, logits = parse_model_results(tokens, results)
+	logits = logits.float()
 	softmax_predict_unmask(tokens, logits, idx)
 	return tokens
 
 
+# Predict one position per row (positions[i] is None to leave row i as is), optionally
+# masking those positions first. Only the rows being updated go through the model.
+def unmask_rows(tokens, model, alphabet, positions, mask=False):
+	active = torch.tensor([p is not None for p in positions])
+	predict_index = torch.tensor([p for p in positions if p is not None])
+	active_tokens = tokens[active]
+	if mask:
+		active_tokens[torch.arange(len(active_tokens)), predict_index] = 33
+	tokens[active] = unmask_token(active_tokens, model, alphabet, predict_index)
+
+
 # mask all 31 residues at once; unmask all at once.
 # This is not expected to work well; only to be used for comparison
-def model_predict_seqs_1(initial_tokens, model, alphabet, idx):
-	name = 'M1_%d' % idx
-	print(name)
-	tokens = initial_tokens.detach().clone()
+def model_predict_seqs_1(batch_tokens, model, alphabet):
+	labels = ['M1_%d' % (i+1) for i in range(len(batch_tokens))]
+	tokens = batch_tokens.detach().clone()
 	apply_mask(tokens, all_masks) # mask all tokens
 	tokens = unmask_token(tokens, model, alphabet) # unmask/predict all tokens
-	return (name, tokens)
+	return (labels, tokens)
 
 
 # mask/unmask one at a time, randomly, mu times (with replacement s.t. may or may not mutate all 31)
-def model_predict_seqs_2(initial_tokens, model, alphabet, idx):
-	mu = random.randint(1,31)
-	name = 'M2_mu%d_%d' % (mu, idx)
-	print(name)
+def model_predict_seqs_2(batch_tokens, model, alphabet):
 	# TODO: should mu be constant
-	tokens = initial_tokens.detach().clone()
-	for i in range(mu):
-		mask = all_masks[random.randint(0, len(all_masks)-1)] 
-		print('Masking/unmasking single token at position %d (iter %d of %d)' % (mask, i+1, mu))
-		apply_mask(tokens, [mask]) # mask a random token
-		tokens = unmask_token(tokens, model, alphabet, mask) # unmask it using softmax dist prediction
-		
-	return (name, tokens)
+	mus = [random.randint(1,31) for _ in range(len(batch_tokens))]
+	labels = ['M2_mu%d_%d' % (mu, i+1) for i,mu in enumerate(mus)]
+	tokens = batch_tokens.detach().clone()
+	for i in range(max(mus)):
+		print('Masking/unmasking single token per seq (iter %d of %d)' % (i+1, max(mus)))
+		# mask a random token, unmask it using softmax dist prediction
+		masks = [random.choice(all_masks) if mu > i else None for mu in mus]
+		unmask_rows(tokens, model, alphabet, masks, mask=True)
+
+	return (labels, tokens)
 
 
 # mask all 31 residues; unmask all one at a time in random order
-def model_predict_seqs_3(initial_tokens, model, alphabet, idx):
-	name = 'M3_%d' % idx
-	print(name)
-	tokens = initial_tokens.detach().clone()
+def model_predict_seqs_3(batch_tokens, model, alphabet):
+	labels = ['M3_%d' % (i+1) for i in range(len(batch_tokens))]
+	tokens = batch_tokens.detach().clone()
 	apply_mask(tokens, all_masks) # mask all tokens
 
-	unmask_order = list(all_masks)
-	random.shuffle(unmask_order)
-	for i,mask in enumerate(unmask_order):
+	unmask_orders = [random.sample(all_masks, len(all_masks)) for _ in range(len(tokens))]
+	for i in range(len(all_masks)):
 		print('Unmasking all tokens in random order (%d of 31)' % (i+1))
-		tokens = unmask_token(tokens, model, alphabet, mask) # unmask all, one at a time, in random order
+		# unmask all, one at a time, in random order
+		unmask_rows(tokens, model, alphabet, [order[i] for order in unmask_orders])
 
-	return (name, tokens)
+	return (labels, tokens)
 
 
 
 # mask a randomly-sized random subset of the 31 residues, unmask all one at a time in random order
-def model_predict_seqs_4(initial_tokens, model, alphabet, idx):
-	tokens = initial_tokens.detach().clone()
-	
+def model_predict_seqs_4(batch_tokens, model, alphabet):
+	tokens = batch_tokens.detach().clone()
+
 	# mask a randomly-sized random subset
-	random_masks = list(all_masks)
-	random.shuffle(random_masks)
-	random_masks = random_masks[:random.randint(1, len(all_masks))]
-	apply_mask(tokens, random_masks)
-	
+	random_masks = [random.sample(all_masks, random.randint(1, len(all_masks))) for _ in range(len(tokens))]
+	for row, masks in enumerate(random_masks):
+		apply_mask(tokens[row:row+1], masks)
 
-	name = 'M4_rand%d_%d' % (len(random_masks), idx)
-	print(name)
-	print('Masking %d (of 31) tokens at once' % len(random_masks))
-	for i,mask in enumerate(random_masks):
-		print('Unmasking %d of %d tokens' % (i+1, len(random_masks)))
-		tokens = unmask_token(tokens, model, alphabet, mask) # unmask all, one at a time
+	labels = ['M4_rand%d_%d' % (len(masks), i+1) for i,masks in enumerate(random_masks)]
+	num_masks = max(len(masks) for masks in random_masks)
+	for i in range(num_masks):
+		print('Unmasking %d of %d tokens' % (i+1, num_masks))
+		# unmask all, one at a time
+		unmask_rows(tokens, model, alphabet, [masks[i] if len(masks) > i else None for masks in random_masks])
 
-	return (name, tokens)
+	return (labels, tokens)
 
 
 
 def parse_model_results(batch_tokens, results, remove_bos_token=False):
 	if remove_bos_token:
-		tokens = np.delete(batch_tokens, (0), axis=1)
-		token_embeddings = np.delete(results["representations"][34], (0), axis=1)
-		logits = np.delete(results["logits"], (0), axis=1)
+		tokens = batch_tokens[:, 1:]
+		token_embeddings = results["representations"][34][:, 1:]
+		logits = results["logits"][:, 1:]
 	else:
 		tokens = batch_tokens
 		token_embeddings = results["representations"][34]
@@ -143,15 +232,16 @@ def parse_model_results(batch_tokens, results, remove_bos_token=False):
 
 # tokens is 1-indexed because of BOS token; masks is also 1-indexed - no need to adjust anything.
 def apply_mask(tokens, masks):
-	for i in range(len(tokens)):
-		for j in masks:
-			tokens[i][j] = 33
+	tokens[:, masks] = 33
 
 
 def tokens2strs(alphabet, batch_tokens):
 	return [''.join((alphabet.get_tok(t) for t in tokens)) for tokens in batch_tokens]
 
 
+# Cached, so the checkpoint is only read once per process however many callers load it.
+# Callers share the returned model, which is always in eval mode.
+@functools.lru_cache(maxsize=1)
 def load_local_model(use_cpu):
 	# (tweaked from pretrained load model)
 	alphabet = esm.Alphabet.from_dict(esm.constants.proteinseq_toks)
@@ -166,24 +256,33 @@ def load_local_model(use_cpu):
 	  Namespace(**model_args), len(alphabet), padding_idx=alphabet.padding_idx
 	)
 	model.load_state_dict(model_state)
+	model.eval()
+
+	if torch.cuda.is_available() and not use_cpu:
+		model = model.cuda()
+		print('Transferred model to GPU')
 
 	return model, alphabet
 
 
-# Predict a specific token (predict_index) or predict all masked
+def model_device(model):
+	return next(model.parameters()).device
+
+
+# Predict a specific token (predict_index) or predict all masked, sampling from the softmax
+# distribution over the logits
 def softmax_predict_unmask(batch_tokens, logits, predict_index=-1):
-	sm = torch.nn.Softmax(dim=1)
-
-	for i in range(len(batch_tokens)):
-		if predict_index > -1:
-			# convert to 2D tensor so it is the same dims as multiple masks
-			softmax_masks = sm(logits[i][predict_index].view(1, 35))
-		else:
-			softmax_masks = sm(logits[i][batch_tokens[i] == 33])
-
-		# torch.amax returns max
-		if softmax_masks.size()[0] > 0:
-			if predict_index > -1:
-				batch_tokens[i][predict_index] = torch.multinomial(softmax_masks, 1)[0][0]
-			else:
-				batch_tokens[i][batch_tokens[i] == 33] = torch.multinomial(softmax_masks, 1)[:,0]
\ No newline at end of file
+	if torch.is_tensor(predict_index) or predict_index > -1:
+		# predict_index is a single position, or a tensor with one position per row
+		rows = torch.arange(len(batch_tokens))
+		batch_tokens[rows, predict_index] = sample_tokens(logits[rows, predict_index])
+	else:
+		masked = batch_tokens == 33
+		if masked.any():
+			batch_tokens[masked] = sample_tokens(logits[masked])
+
+
+# Gumbel-max trick: argmax(logits + Gumbel noise) is distributed as softmax(logits), so this
+# samples like torch.multinomial(softmax(logits), 1) without computing the softmax.
+def sample_tokens(logits):
+	return torch.argmax(logits - torch.empty_like(logits).exponential_().log(), dim=-1)
@@ -1,5 +1,4 @@
 import torch
-import keras
 import os
 import numpy as np
 import pandas as pd
@@ -7,6 +6,10 @@ import xlrd # for excel with pandas
 import subprocess
 import esm_src.esm as esm
 import csv
+import h5py
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from generators import Generators
 import sequence_model_generators as model_gen
 
@@ -18,11 +21,20 @@ data_dir = 'data'
 # cov1_ab_fp = os.path.join(data_dir, 'cov1-antibody.txt')
 foldx_metadata_fp = os.path.join(data_dir, '89ksequences.xlsx')
 seq89k_best100_fp = os.path.join(data_dir, 'best100.xlsx')
+# Columns of the FoldX data used downstream (and kept in its Parquet cache)
+energy_metadata_columns = ['Antibody_ID', 'FoldX_Average_Whole_Model_DDG', 'FoldX_Average_Interface_Only_DDG', 'Statium']
 
 vocab = esm.constants.proteinseq_toks['toks']
 
 embedding_dir = lambda name: os.path.join(data_dir, name + '_embeddings')
 fasta_fp = lambda name: os.path.join(data_dir, name + '.fasta')
+# Single file of embeddings (written by compute_embeddings, or converted from a directory of
+# per-sequence embedding files by consolidate_embeddings). 'embeddings' is one contiguous
+# (N, L, D) array of layer 34 per-token representations, and 'labels' the N labels in row order.
+embedding_h5_fp = lambda name: os.path.join(data_dir, name + '_embeddings.h5')
+
+# Number of threads used to read embedding files in parallel
+reader_workers = int(os.environ.get('READER_WORKERS', 32))
 
 # 1-indexed list of indices to allowed to mutate
 all_masks = [31,32,33,47,50,51,52,54,55,57,58,59,60,61,62,99,100,101,102,103,104,271,273,274,275,335,336,337,338,340,341]
@@ -62,10 +74,11 @@ def run():
 	model_gen.model_predict_seqs(model_gen.model_predict_seqs_4, cov1_ab, 10)
 
 
-def compute_embeddings(name):
+def compute_embeddings(name, use_cpu=False):
 	print('Compute embeddings for %s' % name)
 	assert os.path.exists(fasta_fp(name)), 'Fasta file for %s does not exist' % name
 	assert not os.path.exists(embedding_dir(name)), 'Embeddings for %s already exist' % name
+	assert not os.path.exists(embedding_h5_fp(name)), 'Embeddings for %s already exist' % name
 
 	# Download model manually, otherwise torch method from extract will put it in a cache
 	if not os.path.exists(model_fp):
@@ -73,17 +86,24 @@ def compute_embeddings(name):
 		if not os.path.exists(model_dir): os.mkdir(model_dir)
 		subprocess.run(['curl', '-o', model_fp, model_url])
 
-	# This script will automatically use GPU if possible, but will not have any errors if not. 
-	subprocess.run(['python3', 'esm_src/extract.py', model_fp, fasta_fp(name), embedding_dir(name), 
-		'--repr_layers', '34', '--include', 'mean', 'per_tok'])
+	# Extract in-process (using GPU if possible), writing all embeddings to a single HDF5 file
+	model, alphabet = model_gen.load_local_model(use_cpu)
+	model_gen.extract_embeddings(model, alphabet, fasta_fp(name), embedding_h5_fp(name))
 
 
 def import_energy_metadata():
-	# Get FoldX calculations from Excel spreadsheet
-	assert os.path.exists(foldx_metadata_fp), 'FoldX data file %s does not exist' % foldx_metadata_fp
-	print('Read FoldX data from Excel file')
-	
-	df = pd.read_excel(foldx_metadata_fp, sheet_name=1) # Sheet2
+	# Parsing the Excel file is slow, so after the first import, load from a Parquet cache
+	parquet_fp = os.path.splitext(foldx_metadata_fp)[0] + '.parquet'
+	if os.path.isfile(parquet_fp):
+		print('Read FoldX data from Parquet file')
+		df = pd.read_parquet(parquet_fp, columns=energy_metadata_columns)
+	else:
+		# Get FoldX calculations from Excel spreadsheet
+		assert os.path.exists(foldx_metadata_fp), 'FoldX data file %s does not exist' % foldx_metadata_fp
+		print('Read FoldX data from Excel file')
+
+		df = pd.read_excel(foldx_metadata_fp, sheet_name=1)[energy_metadata_columns] # Sheet2
+		df.to_parquet(parquet_fp)
 
 	# Output FoldX calculations (only) to CSV file for faster future import
 	csv_fp = os.path.splitext(foldx_metadata_fp)[0] + '_foldx_only.csv'
@@ -113,11 +133,11 @@ def load_energy_metadata_foldx(seqs, foldx_dict):
 # Use the full dataframe (which allows importing more info) rather than the faster FoldX-only.
 # This function is mostly deprecated.
 def load_energy_metadata(seqs, energy_metadata):
+	metadata_index = index_energy_metadata(energy_metadata)
 	metadata_dict = []
 	for label in seqs:
-		metadata = energy_metadata.loc[energy_metadata.Antibody_ID==label]
-		assert metadata.shape[0] > 0, 'Expected a metadata entry for %s' % label
-		metadata = metadata.iloc[0]
+		assert label in metadata_index, 'Expected a metadata entry for %s' % label
+		metadata = metadata_index[label]
 		metadata_dict.append([
 			metadata.FoldX_Average_Whole_Model_DDG,
 			metadata.FoldX_Average_Interface_Only_DDG
@@ -126,6 +146,15 @@ def load_energy_metadata(seqs, energy_metadata):
 	return np.stack(metadata_dict)
 
 
+# Map each Antibody_ID to its (first) row of the energy metadata dataframe, so lookups
+# by label don't scan the whole Antibody_ID column.
+def index_energy_metadata(energy_metadata):
+	metadata_index = {}
+	for row in energy_metadata.itertuples():
+		metadata_index.setdefault(row.Antibody_ID, row) # ignore duplicate entries
+	return metadata_index
+
+
 def load_and_convert_89k_best100():
 	assert os.path.exists(seq89k_best100_fp), 'Data file %s dose not exist' % seq89k_best100_fp
 	assert not os.path.exists(fasta_fp('best100')), '89k best 100 fasta file already exists'
@@ -141,30 +170,95 @@ def load_and_convert_89k_best100():
 
 def get_embedding_list(name):
 	assert os.path.exists(fasta_fp(name)), 'Fasta file for %s does not exist' % name
+	if os.path.isfile(embedding_h5_fp(name)):
+		return np.array(list(embedding_index(name).keys()))
 	assert os.path.exists(embedding_dir(name)), 'Embeddings for %s do not exist' % name
 	return np.array([os.path.splitext(x)[0] for x in os.listdir(embedding_dir(name))])
 
 
-def load_embeddings(name, batch, use_cpu=False):
+# One-time conversion of the per-sequence embedding files into a single HDF5 file,
+# so that loading a batch is one open + N dataset reads instead of N torch.load calls.
+def consolidate_embeddings(name):
+	print('Consolidate embeddings for %s' % name)
+	assert os.path.exists(embedding_dir(name)), 'Embeddings for %s do not exist' % name
+	assert not os.path.exists(embedding_h5_fp(name)), 'Consolidated embeddings for %s already exist' % name
+
+	labels = [os.path.splitext(x)[0] for x in os.listdir(embedding_dir(name))]
+	files = [os.path.join(embedding_dir(name), label + '.pt') for label in labels]
+	with model_gen.create_embeddings_file(embedding_h5_fp(name), labels) as f:
+		for i, data in enumerate(load_embedding_files(files, use_cpu=True)):
+			model_gen.write_embeddings(f, i, data['representations'][34][None].numpy())
+
+
+# Map each label in the HDF5 embeddings file to its row
+@functools.lru_cache(maxsize=None)
+def embedding_index(name):
+	with h5py.File(embedding_h5_fp(name), 'r') as f:
+		return {label: i for i, label in enumerate(f['labels'].asstr()[()])}
+
+
+# torch.load embedding files on a thread pool, yielding in order with at most
+# 2 * reader_workers loads in flight
+def load_embedding_files(files, use_cpu=False):
+	map_location = torch.device('cpu') if use_cpu or not torch.cuda.is_available() else None
+	def load(f):
+		data = torch.load(f, map_location=map_location, mmap=True, weights_only=True)
+		return {'label': data['label'], 'representations': {34: data['representations'][34].clone()}}
+
+	with ThreadPoolExecutor(max_workers=reader_workers) as ex:
+		pending = collections.deque()
+		for f in files:
+			if len(pending) == 2 * reader_workers:
+				yield pending.popleft().result()
+			pending.append(ex.submit(load, f))
+		while pending:
+			yield pending.popleft().result()
+
+
+# Yields (label, layer 34 representation) for each label, reading from the consolidated
+# HDF5 file if it exists and otherwise from the per-sequence embedding files.
+def load_representations(name, labels, use_cpu=False):
+	if os.path.isfile(embedding_h5_fp(name)):
+		index = embedding_index(name)
+		assert all(label in index for label in labels), 'Requested embedding(s) not found'
+		with h5py.File(embedding_h5_fp(name), 'r') as f:
+			for label in labels:
+				yield label, torch.from_numpy(f['embeddings'][index[label]])
+		return
+
 	assert os.path.exists(embedding_dir(name)), 'Embeddings for %s do not exist' % name
-	embeddings = []
-	for seq in batch:
-		f = os.path.join(embedding_dir(name), seq + '.pt')
-		assert os.path.isfile(f), 'Requested embedding file(s) not found'
-		if use_cpu or not torch.cuda.is_available():
-			data = torch.load(f, map_location=torch.device('cpu'))
-		else:
-			data = torch.load(f)
-
-		label = data['label']
-		token_embeddings = np.delete(data['representations'][34], (0), axis=1)
-
-		embeddings.append(torch.unsqueeze(token_embeddings, 0))
-
-	X = torch.cat(embeddings, dim=0)
-	X = torch.flatten(X, start_dim=1, end_dim=-1)
-	X = X.numpy()
-	X = keras.utils.normalize(X, axis=-1, order=2)
+	files = [os.path.join(embedding_dir(name), label + '.pt') for label in labels]
+	assert all(os.path.isfile(f) for f in files), 'Requested embedding file(s) not found'
+	for data in load_embedding_files(files, use_cpu):
+		yield data['label'], data['representations'][34]
+
+
+def load_embeddings(name, batch, use_cpu=False):
+	# Copy each embedding straight into its slot of a preallocated array, then flatten (a view)
+	X = None
+	if os.path.isfile(embedding_h5_fp(name)):
+		# HDF5 can read the selection directly into X, with no intermediate array or tensor.
+		# Rows are read in file order so the reads move forward through the contiguous array.
+		index = embedding_index(name)
+		assert all(label in index for label in batch), 'Requested embedding(s) not found'
+		rows = np.array([index[label] for label in batch])
+		with h5py.File(embedding_h5_fp(name), 'r') as f:
+			embeddings = f['embeddings']
+			X = np.empty((len(batch), embeddings.shape[1], embeddings.shape[2] - 1), dtype=np.float32)
+			for i in np.argsort(rows):
+				embeddings.read_direct(X[i], np.s_[rows[i], :, 1:])
+	else:
+		for i, (label, representation) in enumerate(load_representations(name, batch, use_cpu)):
+			token_embeddings = representation[:, 1:]
+			if X is None:
+				X = np.empty((len(batch),) + tuple(token_embeddings.shape), dtype=np.float32)
+			X[i] = token_embeddings.numpy()
+	X = X.reshape(len(batch), -1)
+
+	# L2-normalize rows in place (same as keras.utils.normalize, without the extra copy)
+	norms = np.linalg.norm(X, axis=1)
+	norms[norms == 0] = 1
+	np.divide(X, norms[:, None], out=X)
 	return X
 
 
@@ -181,31 +275,23 @@ when running the workflow locally and using CPU. Mostly deprecated.
 def load_seqs_and_embeddings(name, use_cpu, energy_metadata=None, subset=None):
 	print('Load seqs and embeddings for %s' % name)
 	assert os.path.exists(fasta_fp(name)), 'Fasta file for %s does not exist' % name
-	assert os.path.exists(embedding_dir(name)), 'Embeddings for %s do not exist' % name
 	if energy_metadata is not None:
 		assert type(energy_metadata) == pd.core.frame.DataFrame, 'Unexpected energy metadata type'
 
 
 	print('Load embeddings from files and combine with metadata')
+	if energy_metadata is not None:
+		metadata_index = index_energy_metadata(energy_metadata)
 	embeddings_dict = {}
-	for seq in (subset if subset else os.listdir(embedding_dir(name))):
-		f = os.path.join(embedding_dir(name), seq + ('.pt' if subset else ''))
-		assert os.path.isfile(f), 'Requested embedding file(s) not found'
-		if use_cpu or not torch.cuda.is_available():
-			data = torch.load(f, map_location=torch.device('cpu'))
-		else:
-			data = torch.load(f)
-
-		label = data['label']
-		token_embeddings = np.delete(data['representations'][34], (0), axis=1)
-		# logits = np.delete(data['logits'], (0), axis=1)
+	labels = subset if subset else get_embedding_list(name)
+	for label, representation in load_representations(name, labels, use_cpu):
+		token_embeddings = representation[:, 1:]
+		# logits = data['logits'][:, 1:]
 		d = {'token_embeddings': token_embeddings}
 
 		if energy_metadata is not None:
-			metadata = energy_metadata.loc[energy_metadata.Antibody_ID==label]
-
-			assert metadata.shape[0] > 0, 'Expected a metadata entry for %s' % label
-			metadata = metadata.iloc[0] # ignore duplicate entries
+			assert label in metadata_index, 'Expected a metadata entry for %s' % label
+			metadata = metadata_index[label]
 
 			d['FoldX_Average_Whole_Model_DDG'] = metadata.FoldX_Average_Whole_Model_DDG
 			d['FoldX_Average_Interface_Only_DDG'] = metadata.FoldX_Average_Interface_Only_DDG